@@ -1,25 +1,73 @@
+import asyncio
 import os
-from openai import AzureOpenAI
+import sys
+import httpx
+from openai import AsyncAzureOpenAI
+
+# Maximum number of requests sent to Azure OpenAI at the same time
+MAX_CONCURRENT_REQUESTS = 10
 
 # Initialize Azure OpenAI client
-client = AzureOpenAI(
+# All the requests share the same HTTP/2 connection pool, so the TLS handshake is only done once
+client = AsyncAzureOpenAI(
     azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
     api_key=os.getenv('AZURE_OPENAI_API_KEY'),
-    api_version="2024-02-15-preview"
+    api_version="2024-02-15-preview",
+    # Rate limits and transient errors are retried with an exponential backoff
+    max_retries=3,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=MAX_CONCURRENT_REQUESTS)
+    )
 )
 
-try:
-    print(f"Connecting to: {client.base_url}")
+# The prompts can be passed as arguments, each one is sent as a separate request
+prompts = sys.argv[1:] or ["What is Ockham's Razor?"]
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": "What is Ockham's Razor?"}
-        ]
-    )
+async def ask(prompt, semaphore, echo=False):
+    """Stream the answer to a prompt, and print its tokens as they arrive if echo is set"""
+    async with semaphore:
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+        parts = []
+        async for chunk in stream:
+            # Azure can send chunks without choices, for example the prompt filter results
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                if echo:
+                    sys.stdout.write(delta)
+                    sys.stdout.flush()
+        return "".join(parts)
 
-    print("\nResponse:", response.choices[0].message.content)
+async def main():
+    print(f"Connecting to: {client.base_url}")
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    try:
+        if len(prompts) == 1:
+            # Print the answer while it is being generated
+            print("\nResponse: ", end="", flush=True)
+            await ask(prompts[0], semaphore, echo=True)
+            print()
+        else:
+            answers = await asyncio.gather(*(ask(prompt, semaphore) for prompt in prompts))
+            for answer in answers:
+                print("\nResponse:", answer)
+    finally:
+        # Close the pooled connections cleanly
+        await client.close()
     print("\nThe example run was successful 🥳.")
 
+try:
+    asyncio.run(main())
+
 except Exception as e:
     print(f"An error occurred: {e}")
@@ -53,7 +53,7 @@ run() {
     ssh -o StrictHostKeyChecking=no "azureuser@$PUBLIC_IP" \
             'bash -s' << 'EOS'
                 sudo dnf install -y python39 python39-pip
-                python3.9 -m pip install --user openai
+                python3.9 -m pip install --user openai 'httpx[http2]'
                 export $(cat .env.azure | xargs) && python3.9 /home/azureuser/client.py
 EOS
 
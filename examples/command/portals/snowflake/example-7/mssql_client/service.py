@@ -1,90 +1,445 @@
+import asyncio
 import logging
 import os
-import sys
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+import orjson
 import pymssql
-from flask import request
-from flask import Flask
+from pymssql import _mssql
+import uvicorn
+from quart import request
+from quart import Quart, Response
+from werkzeug.http import http_date
 
 # Environment variables
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = Flask(__name__)
+app = Quart(__name__)
+# Keep the Flask behaviour: no limit on the size of the request bodies and no timeout
+# on receiving them or on sending the (possibly streamed) responses
+app.config['MAX_CONTENT_LENGTH'] = None
+app.config['BODY_TIMEOUT'] = None
+app.config['RESPONSE_TIMEOUT'] = None
 
 MSSQL_USER = os.environ.get('MSSQL_USER')
 MSSQL_PASSWORD = os.environ.get('MSSQL_PASSWORD')
 MSSQL_DATABASE = os.environ.get('MSSQL_DATABASE')
 MSSQL_SERVER = os.environ.get('ENDPOINT_HOST', 'localhost')
+MSSQL_CHARSET = 'UTF-8'
+
+# Session settings applied to every MSSQL connection: the pymssql defaults plus NOCOUNT,
+# which stops the server from sending back a 'rows affected' message after each statement
+MSSQL_CONN_PROPERTIES = (
+    "SET ARITHABORT ON;SET CONCAT_NULL_YIELDS_NULL ON;SET ANSI_NULLS ON;SET ANSI_NULL_DFLT_ON ON;"
+    "SET ANSI_PADDING ON;SET ANSI_WARNINGS ON;SET CURSOR_CLOSE_ON_COMMIT ON;SET QUOTED_IDENTIFIER ON;"
+    "SET TEXTSIZE 2147483647;SET NOCOUNT ON;"
+)
+
+# Connection pool configuration
+MSSQL_POOL_MIN_SIZE = int(os.environ.get('MSSQL_POOL_MIN_SIZE', '2'))
+MSSQL_POOL_MAX_SIZE = int(os.environ.get('MSSQL_POOL_MAX_SIZE', '10'))
+MSSQL_POOL_TIMEOUT = float(os.environ.get('MSSQL_POOL_TIMEOUT', '30'))
+MSSQL_POOL_IDLE_CHECK = float(os.environ.get('MSSQL_POOL_IDLE_CHECK', '30'))
+MSSQL_HEALTH_CHECK_INTERVAL = float(os.environ.get('MSSQL_HEALTH_CHECK_INTERVAL', '30'))
+# How long a new MSSQL connection waits for the server to accept the login, in seconds
+MSSQL_LOGIN_TIMEOUT = int(os.environ.get('MSSQL_LOGIN_TIMEOUT', '15'))
+# How long the health checks wait for MSSQL to accept a new connection, in seconds
+MSSQL_HEALTH_CHECK_TIMEOUT = int(os.environ.get('MSSQL_HEALTH_CHECK_TIMEOUT', '5'))
+
+# Number of rows fetched from MSSQL at a time by /query
+QUERY_FETCH_SIZE = int(os.environ.get('QUERY_FETCH_SIZE', '10000'))
+
+# Number of rows sent to MSSQL in a single batch by /insert
+INSERT_BATCH_SIZE = int(os.environ.get('INSERT_BATCH_SIZE', '1000'))
+
+# Parameter placeholders, as parsed by pymssql: %s or %d for positional parameters, %(name)s or %(name)d for named ones
+PLACEHOLDER = re.compile(r'%\(([^)]+)\)[sd]|%[sd]')
 
 # Create connection function
-def get_connection():
+def get_connection(login_timeout=MSSQL_LOGIN_TIMEOUT):
     return pymssql.connect(
         server=MSSQL_SERVER,
         user=MSSQL_USER,
         password=MSSQL_PASSWORD,
-        database=MSSQL_DATABASE
+        database=MSSQL_DATABASE,
+        charset=MSSQL_CHARSET,
+        login_timeout=login_timeout,
+        tds_version='7.4',
+        conn_properties=MSSQL_CONN_PROPERTIES
     )
 
+class PoolExhausted(RuntimeError):
+    """Raised when no connection becomes available in time"""
+
+class ConnectionPool:
+    """
+    A bounded pool of MSSQL connections shared by all the requests.
+    Connections which have been idle for a while are checked with a 'SELECT 1'
+    before being handed out, and broken connections are replaced.
+    """
+
+    def __init__(self, connect, min_size, max_size, timeout, idle_check):
+        self._connect = connect
+        self._min_size = min_size
+        self._timeout = timeout
+        self._idle_check = idle_check
+        # each entry is a (connection, last_used) pair
+        self._idle = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._max_size = max_size
+
+    def fill(self):
+        """Open the minimum number of connections"""
+        while True:
+            with self._lock:
+                if self._size >= self._min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._new_connection()
+            except Exception as e:
+                logging.error(f"Cannot open an MSSQL connection for the pool: {str(e)}")
+                return
+            self._idle.put((conn, time.monotonic()))
+
+    def clear(self):
+        """Close all the idle connections, new ones are opened by the next acquire() calls"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    @contextmanager
+    def acquire(self, timeout=None, **connect_args):
+        """
+        Borrow a connection from the pool and give it back when done.
+        :param timeout: how long to wait for a connection, the pool timeout by default, 0 to not wait
+        :param connect_args: arguments of the connect function, if a new connection has to be opened
+        """
+        conn = self._get(self._timeout if timeout is None else timeout, connect_args)
+        try:
+            yield conn
+        except pymssql.OperationalError:
+            # the connection is most likely broken, don't give it back
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    def _get(self, timeout, connect_args):
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_grow = self._size < self._max_size
+                if can_grow:
+                    self._size += 1
+            if can_grow:
+                return self._new_connection(**connect_args)
+            try:
+                conn, last_used = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise PoolExhausted(f"No MSSQL connection available after {timeout}s")
+
+        if time.monotonic() - last_used > self._idle_check and not self._is_alive(conn):
+            logging.info("Replacing a stale MSSQL connection")
+            self._close(conn)
+            return self._new_connection(**connect_args)
+        return conn
+
+    def _new_connection(self, **connect_args):
+        """Open a connection for a slot which has already been reserved"""
+        try:
+            return self._connect(**connect_args)
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _release(self, conn):
+        """Give a connection back, discarding any work which was not committed"""
+        try:
+            conn.rollback()
+        except pymssql.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    def _discard(self, conn):
+        self._close(conn)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except pymssql.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except pymssql.Error:
+            pass
+
+pool = ConnectionPool(
+    get_connection,
+    min_size=MSSQL_POOL_MIN_SIZE,
+    max_size=MSSQL_POOL_MAX_SIZE,
+    timeout=MSSQL_POOL_TIMEOUT,
+    idle_check=MSSQL_POOL_IDLE_CHECK,
+)
+
+# Threads running the blocking database calls, one per pooled connection
+executor = ThreadPoolExecutor(max_workers=MSSQL_POOL_MAX_SIZE, thread_name_prefix='mssql')
+
+async def run_blocking(function, *args):
+    """
+    Run a blocking function, typically a database call, in the worker threads
+    so that the event loop keeps serving other requests in the meantime.
+    Each call borrows its own connection from the pool, connections are never shared between requests.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+# A thread of its own for /ready, so that the health check doesn't wait for the busy worker threads
+health_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mssql-ready')
+
+# Requests wait here for a free MSSQL connection rather than in the worker threads.
+# Otherwise the waiting requests could hold all the threads while a streamed /query,
+# which keeps its connection, needs a thread for each of its steps.
+connection_slots = asyncio.Semaphore(MSSQL_POOL_MAX_SIZE)
+
+async def run_with_connection(function, *args):
+    """Run a blocking function which borrows a pooled connection, once a connection is available"""
+    async with connection_slots:
+        return await run_blocking(function, *args)
+
+async def iterate_blocking(generator):
+    """
+    Iterate over a blocking generator which borrows a pooled connection,
+    running each step in the worker threads once a connection is available
+    """
+    async with connection_slots:
+        try:
+            while True:
+                item = await run_blocking(next, generator, None)
+                if item is None:
+                    return
+                yield item
+        finally:
+            await run_blocking(generator.close)
+
+def json_default(value):
+    """Serialize the values which are not supported by orjson like the default Quart JSON provider does"""
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(value) -> bytes:
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
 @app.route("/query", methods=["POST"])
-def query():
-    message = request.json
-    logging.info(f"Received message: {message}")
+async def query():
+    message = await request.get_json()
+    logging.info("Received message: %s", message)
     user_query = message['data'][0][1]
-    logging.info(f"Received query: {user_query}")
-
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(user_query)
-            columns = [column[0] for column in cursor.description]
-            rows = [list(row) for row in cursor.fetchall()]
-            rows = [columns] + rows
-            data = {
-                'data': [[0, rows]],
-            }
-    logging.info(f"Returning data: {data}")
-    return data
+    logging.info("Received query: %s", user_query)
+
+    def run_query():
+        """
+        Produce the JSON response {"data": [[0, [columns, row, row, ...]]]} in pieces,
+        fetching the rows in batches so that the whole result set is never held in memory
+        """
+        with pool.acquire() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(user_query)
+                columns = [column[0] for column in cursor.description]
+                yield b'{"data":[[0,[' + dump_json(columns)
+                while True:
+                    rows = cursor.fetchmany(QUERY_FETCH_SIZE)
+                    if not rows:
+                        break
+                    # encode the batch as a list and strip its brackets
+                    yield b',' + dump_json(rows)[1:-1]
+                yield b']]]}'
+
+    # Execute the query before sending the response, so that an error is still reported with a status code
+    chunks = iterate_blocking(run_query())
+    first_chunk = await chunks.__anext__()
+
+    async def body():
+        yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return Response(body(), mimetype='application/json')
 
 @app.route("/execute", methods=["POST"])
-def execute():
-    message = request.json
-    logging.info(f"Received message: {message}")
+async def execute():
+    message = await request.get_json()
+    logging.info("Received message: %s", message)
     user_query = message['data'][0][1]
-    logging.info(f"Received query: {user_query}")
+    logging.info("Received query: %s", user_query)
 
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(user_query)
-            conn.commit()
+    def run_execute():
+        with pool.acquire() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(user_query)
+                conn.commit()
+
+    await run_with_connection(run_execute)
     return {
         'data': [[0, "SUCCESS"]],
     }
 
+def insert_statements(user_query, values):
+    """
+    Produce the INSERT statement of each row inserted by /insert, with the row values substituted.
+    Rows are lists of positional parameters, objects of named parameters or single values.
+    Each row is substituted on its own, since pymssql splices every parameter into the whole query text
+    and substituting a whole batch at once gets quadratically slower with the batch size.
+    """
+    names = [match.group(1) for match in PLACEHOLDER.finditer(user_query)]
+    named = any(name is not None for name in names)
+    if named and None in names:
+        raise ValueError("The query cannot mix positional and named parameters")
+    # named placeholders are replaced with positional ones, so that every row is substituted the same way
+    statement = PLACEHOLDER.sub('%s', user_query.strip())
+
+    for row in values:
+        if isinstance(row, dict):
+            if not named:
+                raise ValueError(f"The query has no named parameters for the row: {row}")
+            missing = [name for name in names if name not in row]
+            if missing:
+                raise ValueError(f"Missing values for {', '.join(missing)} in the row: {row}")
+            params = tuple(row[name] for name in names)
+        else:
+            # a single value is used as the only parameter of the statement
+            params = tuple(row) if isinstance(row, (list, tuple)) else (row,)
+            if len(params) != len(names):
+                raise ValueError(f"Expected {len(names)} values, got {len(params)} in the row: {row}")
+        yield _mssql.substitute_params(statement, params, MSSQL_CHARSET).decode(MSSQL_CHARSET)
+
+def insert_batches(user_query, values):
+    """
+    Group the statements inserting the rows of /insert into batches of INSERT_BATCH_SIZE statements,
+    so that each batch is sent to the server in a single round trip
+    """
+    batch = []
+    for statement in insert_statements(user_query, values):
+        batch.append(statement)
+        if len(batch) == INSERT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 @app.route("/insert", methods=["POST"])
-def insert():
-    message = request.json
-    logging.info(f"Received message: {message}")
+async def insert():
+    message = await request.get_json()
     user_query = message['data'][0][1]
-    logging.info(f"Received query: {user_query}")
+    logging.info("Received query: %s", user_query)
     values = message['data'][0][2]
-    logging.info(f"Received values: {values}")
+    # the rows can be a large payload, they are only logged at the debug level
+    logging.info("Received %d rows", len(values))
+    logging.debug("Received values: %s", values)
 
     if len(values) == 0:
         return {
             'data': [[0, "SUCCESS"]],
         }
 
-    with get_connection() as conn:
-        with conn.cursor() as cursor:
-            for value in values:
-                cursor.execute(user_query, value)
-            conn.commit()
+    def run_insert():
+        batches = list(insert_batches(user_query, values))
+
+        with pool.acquire() as conn:
+            # The transaction is started and committed by the batches themselves rather than with conn.commit(),
+            # so that the commit is sent to the server in the same batch as the last rows and the driver
+            # never has a chance to interrupt the server before all the rows are written.
+            conn.autocommit(True)
+            try:
+                with conn.cursor() as cursor:
+                    for index, statements in enumerate(batches):
+                        if index == 0:
+                            # XACT_ABORT rolls back the whole transaction if any of the rows fails
+                            statements.insert(0, "SET XACT_ABORT ON; BEGIN TRAN")
+                        if index == len(batches) - 1:
+                            statements.append("COMMIT TRAN; SET XACT_ABORT OFF")
+                        # statements are separated by new lines so that a trailing '--' comment doesn't hide the next one
+                        cursor.execute("\n".join(statements))
+            except Exception:
+                # don't let a broken connection hide the original error
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("IF @@TRANCOUNT > 0 ROLLBACK TRAN; SET XACT_ABORT OFF")
+                except pymssql.Error as e:
+                    logging.warning(f"Cannot roll back the insert transaction: {str(e)}")
+                raise
+            finally:
+                try:
+                    conn.autocommit(False)
+                except pymssql.Error as e:
+                    logging.warning(f"Cannot restore the transaction mode of the connection: {str(e)}")
+
+    await run_with_connection(run_insert)
     return {
         'data': [[0, "SUCCESS"]],
     }
 
 @app.route("/ready", methods=["GET"])
-def ready():
-    return {}
+async def ready():
+    if await asyncio.get_running_loop().run_in_executor(health_executor, ping_mssql):
+        return {}
+    return {'error': "MSSQL cannot be reached"}, 503
+
+def ping_mssql() -> bool:
+    """
+    Check that MSSQL can be reached, the pooled connections are evicted if it can't.
+    The check doesn't wait for a busy pool: when all the connections are in use the server is considered reachable.
+    """
+    try:
+        with pool.acquire(timeout=0, login_timeout=MSSQL_HEALTH_CHECK_TIMEOUT) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+        return True
+    except PoolExhausted:
+        return True
+    except pymssql.OperationalError as e:
+        logging.warning(f"MSSQL health check failed, closing the pooled connections: {str(e)}")
+        pool.clear()
+        return False
+    except Exception as e:
+        logging.warning(f"MSSQL health check failed: {str(e)}")
+        return False
+
+def health_loop():
+    """Periodically check the MSSQL connections so that stale ones are evicted before a request uses them"""
+    while True:
+        time.sleep(MSSQL_HEALTH_CHECK_INTERVAL)
+        ping_mssql()
 
 def print_environment_variables():
     """
@@ -112,7 +467,7 @@ def print_environment_variables():
 def test_connection():
     """Test the database connection with a simple system query"""
     try:
-        with get_connection() as conn:
+        with pool.acquire() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SELECT @@VERSION AS SQLServerVersion;")
                 version = cursor.fetchone()[0]
@@ -121,7 +476,18 @@ def test_connection():
     except Exception as e:
         logging.error(f"Connection test failed: {str(e)}")
 
-if __name__ == "__main__":
+@app.before_serving
+async def startup():
+    """
+    Open the MSSQL connections when a server process starts.
+    When running with several gunicorn workers each process gets its own pool,
+    since pymssql connections cannot be shared across a fork.
+    """
     print_environment_variables()
-    test_connection()
-    app.run(host='0.0.0.0', port=8080)
+    await run_blocking(pool.fill)
+    await run_blocking(test_connection)
+    threading.Thread(target=health_loop, name='mssql-health', daemon=True).start()
+
+if __name__ == "__main__":
+    # The Docker image runs the service with gunicorn, this is a single process server for local runs
+    uvicorn.run(app, host='0.0.0.0', port=8080, loop='uvloop', http='httptools')
@@ -1,10 +1,22 @@
+import asyncio
 import logging
 import os
+import queue
+import re
 import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pymssql
+import uvicorn
 import connection
-from flask import Flask, request
-from snowflake import connector
+from quart import Quart, request
+from snowflake.connector.errorcode import ER_CONNECTION_IS_CLOSED
 from snowflake.connector.errors import ProgrammingError, DatabaseError
 
 # Environment variables
@@ -12,7 +24,12 @@ WAREHOUSE = os.getenv('SNOWFLAKE_WAREHOUSE', "reference('WAREHOUSE')")
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = Flask(__name__)
+app = Quart(__name__)
+# Keep the Flask behaviour: no limit on the size of the request bodies and no timeout
+# on receiving them or on sending the (possibly streamed) responses
+app.config['MAX_CONTENT_LENGTH'] = None
+app.config['BODY_TIMEOUT'] = None
+app.config['RESPONSE_TIMEOUT'] = None
 
 # MSSQL Configuration
 MSSQL_USER = os.environ.get('MSSQL_USER')
@@ -21,24 +38,209 @@ MSSQL_DATABASE = os.environ.get('MSSQL_DATABASE')
 MSSQL_SERVER = os.environ.get('ENDPOINT_HOST', 'localhost')
 MSSQL_PORT = os.environ.get('ENDPOINT_PORT', '1433')
 
+# Session settings applied to every MSSQL connection: the pymssql defaults plus NOCOUNT,
+# which stops the server from sending back a 'rows affected' message after each statement
+MSSQL_CONN_PROPERTIES = (
+    "SET ARITHABORT ON;SET CONCAT_NULL_YIELDS_NULL ON;SET ANSI_NULLS ON;SET ANSI_NULL_DFLT_ON ON;"
+    "SET ANSI_PADDING ON;SET ANSI_WARNINGS ON;SET CURSOR_CLOSE_ON_COMMIT ON;SET QUOTED_IDENTIFIER ON;"
+    "SET TEXTSIZE 2147483647;SET NOCOUNT ON;"
+)
+
+MSSQL_POOL_MIN_SIZE = int(os.environ.get('MSSQL_POOL_MIN_SIZE', '2'))
+MSSQL_POOL_MAX_SIZE = int(os.environ.get('MSSQL_POOL_MAX_SIZE', '10'))
+MSSQL_POOL_TIMEOUT = float(os.environ.get('MSSQL_POOL_TIMEOUT', '30'))
+MSSQL_POOL_IDLE_CHECK = float(os.environ.get('MSSQL_POOL_IDLE_CHECK', '30'))
+MSSQL_HEALTH_CHECK_INTERVAL = float(os.environ.get('MSSQL_HEALTH_CHECK_INTERVAL', '30'))
+# How long a new MSSQL connection waits for the server to accept the login, in seconds
+MSSQL_LOGIN_TIMEOUT = int(os.environ.get('MSSQL_LOGIN_TIMEOUT', '15'))
+# How long the health checks wait for MSSQL to accept a new connection, in seconds
+MSSQL_HEALTH_CHECK_TIMEOUT = int(os.environ.get('MSSQL_HEALTH_CHECK_TIMEOUT', '5'))
+
+# Number of rows fetched from MSSQL at a time and uploaded as one file when copying a table to Snowflake
+COPY_FETCH_SIZE = int(os.environ.get('COPY_FETCH_SIZE', '50000'))
+
+# A table name with an optional database and schema, each part is either a plain identifier or a quoted one.
+# MSSQL quotes identifiers with "My Table" or [My Table], Snowflake only with "My Table".
+SNOWFLAKE_IDENTIFIER = r'(?:[A-Za-z_][A-Za-z0-9_$]*|"[^"]+")'
+MSSQL_IDENTIFIER = r'(?:[A-Za-z_][A-Za-z0-9_$]*|"[^"]+"|\[[^\]]+\])'
+SNOWFLAKE_TABLE_NAME = re.compile(rf'{SNOWFLAKE_IDENTIFIER}(?:\.{SNOWFLAKE_IDENTIFIER}){{0,2}}')
+MSSQL_TABLE_NAME = re.compile(rf'{MSSQL_IDENTIFIER}(?:\.{MSSQL_IDENTIFIER}){{0,2}}')
+
 # Snowflake session
 session = None
+session_lock = threading.Lock()
+session_last_used = 0.0
+# Number of queries running on each session, a replaced session is only closed once none runs on it
+session_users = {}
+# The session is checked with a 'SELECT 1' before being used when it has been idle for longer than this
+SNOWFLAKE_IDLE_CHECK = float(os.getenv('SNOWFLAKE_IDLE_CHECK', '300'))
 
 # MSSQL Connection
-def get_mssql_connection():
+def get_mssql_connection(login_timeout=MSSQL_LOGIN_TIMEOUT):
     """Create MSSQL connection"""
     return pymssql.connect(
         server=MSSQL_SERVER,
         user=MSSQL_USER,
         password=MSSQL_PASSWORD,
         database=MSSQL_DATABASE,
-        port=MSSQL_PORT
+        port=MSSQL_PORT,
+        login_timeout=login_timeout,
+        tds_version='7.4',
+        conn_properties=MSSQL_CONN_PROPERTIES
     )
 
+class PoolExhausted(RuntimeError):
+    """Raised when no connection becomes available in time"""
+
+class ConnectionPool:
+    """
+    A bounded pool of MSSQL connections shared by all the requests.
+    Connections which have been idle for a while are checked with a 'SELECT 1'
+    before being handed out, and broken connections are replaced.
+    """
+
+    def __init__(self, connect, min_size, max_size, timeout, idle_check):
+        self._connect = connect
+        self._min_size = min_size
+        self._timeout = timeout
+        self._idle_check = idle_check
+        # each entry is a (connection, last_used) pair
+        self._idle = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._max_size = max_size
+
+    def fill(self):
+        """Open the minimum number of connections"""
+        while True:
+            with self._lock:
+                if self._size >= self._min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._new_connection()
+            except Exception as e:
+                logging.error(f"Cannot open an MSSQL connection for the pool: {str(e)}")
+                return
+            self._idle.put((conn, time.monotonic()))
+
+    def clear(self):
+        """Close all the idle connections, new ones are opened by the next acquire() calls"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    @contextmanager
+    def acquire(self, timeout=None, **connect_args):
+        """
+        Borrow a connection from the pool and give it back when done.
+        :param timeout: how long to wait for a connection, the pool timeout by default, 0 to not wait
+        :param connect_args: arguments of the connect function, if a new connection has to be opened
+        """
+        conn = self._get(self._timeout if timeout is None else timeout, connect_args)
+        try:
+            yield conn
+        except pymssql.OperationalError:
+            # the connection is most likely broken, don't give it back
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    def _get(self, timeout, connect_args):
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_grow = self._size < self._max_size
+                if can_grow:
+                    self._size += 1
+            if can_grow:
+                return self._new_connection(**connect_args)
+            try:
+                conn, last_used = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise PoolExhausted(f"No MSSQL connection available after {timeout}s")
+
+        if time.monotonic() - last_used > self._idle_check and not self._is_alive(conn):
+            logging.info("Replacing a stale MSSQL connection")
+            self._close(conn)
+            return self._new_connection(**connect_args)
+        return conn
+
+    def _new_connection(self, **connect_args):
+        """Open a connection for a slot which has already been reserved"""
+        try:
+            return self._connect(**connect_args)
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _release(self, conn):
+        """Give a connection back, discarding any work which was not committed"""
+        try:
+            conn.rollback()
+        except pymssql.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    def _discard(self, conn):
+        self._close(conn)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except pymssql.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except pymssql.Error:
+            pass
+
+mssql_pool = ConnectionPool(
+    get_mssql_connection,
+    min_size=MSSQL_POOL_MIN_SIZE,
+    max_size=MSSQL_POOL_MAX_SIZE,
+    timeout=MSSQL_POOL_TIMEOUT,
+    idle_check=MSSQL_POOL_IDLE_CHECK,
+)
+
+# Threads running the blocking MSSQL and Snowflake calls, one per pooled connection
+executor = ThreadPoolExecutor(max_workers=MSSQL_POOL_MAX_SIZE, thread_name_prefix='db')
+
+async def run_blocking(function, *args):
+    """
+    Run a blocking function, typically a database call, in the worker threads
+    so that the event loop keeps serving other requests in the meantime.
+    Each call borrows its own MSSQL connection from the pool, connections are never shared between requests.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+# A thread of its own for /ready, so that the health check doesn't wait for the busy worker threads
+health_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mssql-ready')
+
 def test_mssql_connection():
     """Test the MSSQL database connection"""
     try:
-        with get_mssql_connection() as conn:
+        with mssql_pool.acquire() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SELECT @@VERSION AS SQLServerVersion;")
                 version = cursor.fetchone()[0]
@@ -48,13 +250,116 @@ def test_mssql_connection():
         logging.error(f"Connection test failed: {str(e)}")
         raise
 
+def ping_mssql() -> bool:
+    """
+    Check that MSSQL can be reached, the pooled connections are evicted if it can't.
+    The check doesn't wait for a busy pool: when all the connections are in use the server is considered reachable.
+    """
+    try:
+        with mssql_pool.acquire(timeout=0, login_timeout=MSSQL_HEALTH_CHECK_TIMEOUT) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+        return True
+    except PoolExhausted:
+        return True
+    except pymssql.OperationalError as e:
+        logging.warning(f"MSSQL health check failed, closing the pooled connections: {str(e)}")
+        mssql_pool.clear()
+        return False
+    except Exception as e:
+        logging.warning(f"MSSQL health check failed: {str(e)}")
+        return False
+
+def health_loop():
+    """Periodically check the MSSQL connections so that stale ones are evicted before a request uses them"""
+    while True:
+        time.sleep(MSSQL_HEALTH_CHECK_INTERVAL)
+        ping_mssql()
+
+# Snowflake Session
+def connect_snowflake():
+    """Create the Snowflake session and select the referenced warehouse, closing the previous session if it is not used"""
+    global session, session_last_used
+    previous = session
+    session = connection.session()
+    use_snowflake_referenced_warehouse()
+    session_last_used = time.monotonic()
+    if previous is not None and previous not in session_users:
+        close_snowflake_connection(previous)
+
+def close_snowflake_connection(old_session):
+    """
+    Close the connection of a session which has been replaced.
+    Session.close() is not used because it also cancels all the queries of the session.
+    """
+    try:
+        old_session.connection.close()
+    except Exception as e:
+        logging.info(f"Cannot close the previous Snowflake connection: {type(e).__name__} - {str(e)}")
+
+def is_snowflake_session_alive() -> bool:
+    """Check the Snowflake session with a cheap query"""
+    try:
+        session.sql("SELECT 1").collect()
+        return True
+    except Exception as e:
+        logging.info(f"The Snowflake session check failed: {type(e).__name__} - {str(e)}")
+        return False
+
+@contextmanager
+def use_snowflake_session(failed_session=None):
+    """
+    Use the shared Snowflake session, which is recreated first if its connection is closed,
+    if it doesn't answer after being idle for a while, or if it is the failed session.
+    The session is shared with other threads, so a replaced session is closed by the last thread using it.
+    """
+    global session_last_used
+    with session_lock:
+        if session is None or session.connection.is_closed():
+            logging.info("The Snowflake connection is closed, reconnecting")
+            connect_snowflake()
+        elif session is failed_session:
+            connect_snowflake()
+        elif time.monotonic() - session_last_used > SNOWFLAKE_IDLE_CHECK and not is_snowflake_session_alive():
+            logging.info("The Snowflake session is not responding, reconnecting")
+            connect_snowflake()
+        session_last_used = time.monotonic()
+        current = session
+        session_users[current] = session_users.get(current, 0) + 1
+    try:
+        yield current
+    finally:
+        with session_lock:
+            session_users[current] -= 1
+            if session_users[current] == 0:
+                del session_users[current]
+                if current is not session:
+                    close_snowflake_connection(current)
+
+def run_snowflake_sql(query, values=None):
+    """
+    Run a query with the shared Snowflake session.
+    If the connection is lost during the query the session is recreated and the query is retried once.
+    """
+    with use_snowflake_session() as current:
+        try:
+            return current.sql(query, values).collect()
+        except DatabaseError as e:
+            # Only a lost connection is worth a new session, the other errors would fail the same way
+            if not (current.connection.is_closed() or e.errno == ER_CONNECTION_IS_CLOSED):
+                raise
+            logging.warning(f"Snowflake connection error, reconnecting: {type(e).__name__} - {str(e)}")
+    with use_snowflake_session(failed_session=current) as current:
+        return current.sql(query, values).collect()
+
 # Snowflake Query
-def execute_snowflake_query(query, values=[]) -> bool:
+def execute_snowflake_query(query, values=None) -> bool:
     """Execute a Snowflake SQL query"""
     try:
-        logging.info(f"Executing query: {query}, with values {values}")
-        session.sql(query, values).collect()
-        logging.info(f"Query execution successful")
+        logging.info("Executing query: %s, with values %s", query, values)
+        run_snowflake_sql(query, values)
+        logging.info("Query execution successful")
         return True
     except (ProgrammingError, DatabaseError) as e:
         logging.error(f"Snowflake Error: {type(e).__name__} - {str(e)}")
@@ -73,46 +378,112 @@ def use_snowflake_referenced_warehouse():
         logging.error(f"Cannot use the referenced warehouse: {type(e).__name__} - {str(e)}")
         raise
 
+def check_table_name(name, pattern):
+    """Check that a table name, optionally qualified with its database and schema, is a valid identifier"""
+    if not pattern.fullmatch(name):
+        raise ValueError(f"Invalid table name: {name}")
+
+def arrow_type(type_code):
+    """
+    Return the Arrow type of a column given its pymssql type code, or None if it must be inferred from the values.
+    Only character columns can be mapped directly, the other codes cover several Python types
+    (int, float or bool for NUMBER for example).
+    """
+    if type_code == pymssql.STRING:
+        return pa.string()
+    return None
+
+def stage_parquet_files(cursor, stage) -> int:
+    """
+    Fetch the rows of an executed query in chunks and upload each chunk to a stage as a Parquet file,
+    so that neither the memory nor the local disk ever hold the whole result set.
+    A chunk is uploaded in the background while the next one is being fetched.
+    :return: the number of rows uploaded
+    """
+    columns = [column[0] for column in cursor.description]
+    # Only the types given by the column description are decided once for the whole result set.
+    # The other ones are inferred again for each chunk: each chunk is a separate file, loaded by column name,
+    # and a type inferred from one chunk may not fit the next one (the precision of a decimal for example).
+    types = [arrow_type(column[1]) for column in cursor.description]
+    rows_staged = 0
+    upload = None
+    with tempfile.TemporaryDirectory() as local_dir, ThreadPoolExecutor(max_workers=1) as uploader:
+        while True:
+            rows = cursor.fetchmany(COPY_FETCH_SIZE)
+            if not rows:
+                break
+            # Convert the chunk column by column, so that pyarrow converts each column in one call
+            # instead of going through a Python dict per row
+            arrays = [pa.array(values, type=column_type) for values, column_type in zip(zip(*rows), types)]
+            table = pa.Table.from_arrays(arrays, names=columns)
+
+            path = os.path.join(local_dir, f"part_{rows_staged}.parquet")
+            pq.write_table(table, path, compression='snappy')
+            rows_staged += len(rows)
+
+            # Wait for the previous upload, at most one file is uploaded at a time
+            if upload is not None:
+                upload.result()
+            upload = uploader.submit(upload_file, path, stage)
+
+        if upload is not None:
+            upload.result()
+    return rows_staged
+
+def upload_file(path, stage):
+    """Upload a local file to a stage and delete it"""
+    logging.info("Uploading %s to %s", path, stage)
+    run_snowflake_sql(f"PUT file://{path} {stage} AUTO_COMPRESS=FALSE")
+    os.remove(path)
+
+def load_stage(stage, target_table) -> bool:
+    """Load the Parquet files of a stage into the target table with COPY INTO"""
+    return execute_snowflake_query(
+        f"COPY INTO {target_table} FROM {stage} "
+        "FILE_FORMAT=(TYPE=PARQUET USE_LOGICAL_TYPE=TRUE) MATCH_BY_COLUMN_NAME=CASE_INSENSITIVE"
+    )
+
 # Snowflake Copy
 @app.route("/copy_to_snowflake", methods=["POST"])
-def copy_to_snowflake():
-    message = request.json
-    logging.info(f"Received message: {message}")
+async def copy_to_snowflake():
+    message = await request.get_json()
+    logging.info("Received message: %s", message)
 
     source_table = message['data'][0][1]
     target_table = message['data'][0][2]
 
-    logging.info(f"Copying from {source_table} to {target_table}")
+    logging.info("Copying from %s to %s", source_table, target_table)
 
-    try:
-        # Get data from MSSQL
-        with get_mssql_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(f"SELECT * FROM {source_table}")
-                columns = [column[0] for column in cursor.description]
-                rows = [list(row) for row in cursor.fetchall()]
-
-                # Format data for Snowflake
-                columns_str = ", ".join(columns)
-                values_list = []
-                for row in rows:
-                    values = [f"'{str(val)}'" if isinstance(val, str) else str(val) for val in row]
-                    values_list.append(f"({', '.join(values)})")
-
-                # Insert data into Snowflake
-                insert_sql = f"INSERT INTO {target_table} ({columns_str}) VALUES {', '.join(values_list)}"
-                result = execute_snowflake_query(insert_sql)
+    def run_copy():
+        # The table names are the only values which are still part of the SQL text
+        check_table_name(source_table, MSSQL_TABLE_NAME)
+        check_table_name(target_table, SNOWFLAKE_TABLE_NAME)
+        stage = f"@~/stage_{uuid.uuid4().hex}"
+        try:
+            # Stream the data from MSSQL to the stage
+            with mssql_pool.acquire() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"SELECT * FROM {source_table}")
+                    rows_copied = stage_parquet_files(cursor, stage)
+
+            if rows_copied > 0:
+                # Bulk load the staged files into Snowflake
+                result = load_stage(stage, target_table)
                 if result is False:
                     error_msg = "Failed to insert data into target table. Check service logs for more details."
                     logging.error(error_msg)
                     return {
                         'data': [[0, error_msg]]
                     }
+        finally:
+            execute_snowflake_query(f"REMOVE {stage}")
 
-                rows_inserted = len(rows)
-                return {
-                    'data': [[0, f"Successfully copied {rows_inserted} rows from {source_table} to {target_table}"]]
-                }
+        return {
+            'data': [[0, f"Successfully copied {rows_copied} rows from {source_table} to {target_table}"]]
+        }
+
+    try:
+        return await run_blocking(run_copy)
     except Exception as e:
         error_msg = str(e)
         logging.error(f"Error: {error_msg}")
@@ -120,15 +491,34 @@ def copy_to_snowflake():
             'data': [[0, f"Error: {error_msg}"]]
         }
 
-def main():
-    global session
-    # Connect to Snowflake
-    session = connection.session()
+@app.route("/ready", methods=["GET"])
+async def ready():
+    if await asyncio.get_running_loop().run_in_executor(health_executor, ping_mssql):
+        return {}
+    return {'error': "MSSQL cannot be reached"}, 503
+
+@app.before_serving
+async def startup():
+    """
+    Connect to Snowflake and MSSQL when a server process starts.
+    When running with several gunicorn workers each process gets its own connections,
+    since neither the pymssql connections nor the Snowflake session can be shared across a fork.
+    """
     try:
         logging.info(f"Start the server")
-        use_snowflake_referenced_warehouse()
-        test_mssql_connection()
-        app.run(host='0.0.0.0', port=8080)
+        # Connect to Snowflake
+        await run_blocking(connect_snowflake)
+        await run_blocking(mssql_pool.fill)
+        await run_blocking(test_mssql_connection)
+        threading.Thread(target=health_loop, name='mssql-health', daemon=True).start()
+    except Exception as e:
+        logging.error(f"Fatal error at startup: {e}")
+        raise
+
+def main():
+    # The Docker image runs the service with gunicorn, this is a single process server for local runs
+    try:
+        uvicorn.run(app, host='0.0.0.0', port=8080, loop='uvloop', http='httptools')
     except Exception as e:
         logging.error(f"Fatal error in main: {e}")
         sys.exit(1)